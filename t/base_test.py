@@ -12,27 +12,51 @@ import time
 import hashlib
 import base64
 import inspect
+import functools
+import contextlib
+import atexit
+import shutil
+import subprocess
 from tempfile import mkdtemp
 
-from threading import Thread
-from testgres.enums import NodeStatus
+from concurrent.futures import ThreadPoolExecutor
+from testgres.consts import PG_PID_FILE
 from testgres.utils import get_pg_version, get_pg_config
 
+# directory for node base dirs, point it to tmpfs to keep data out of disk
+TMP_DIR = os.getenv('TESTGRES_TMPFS_DIR')
 
-class BaseTest(unittest.TestCase):
-	replica = None
-	basePort = None
-	_myName = None
+# sorted names of test files per test directory, shared by all test classes
+_CACHED_TEST_FILES = {}
 
-	def getTestNum(self):
-		testFullName = inspect.getfile(self.__class__)
+
+def get_test_files(test_dir):
+	if test_dir not in _CACHED_TEST_FILES:
 		names = []
-		for entry in os.scandir(os.path.dirname(testFullName)):
+		for entry in os.scandir(test_dir):
 			if entry.is_file() and entry.name.endswith(
 			    '_test.py') and entry.name != 'base_test.py':
 				names.append(entry.name)
 		names.sort()
-		return names.index(os.path.basename(testFullName))
+		_CACHED_TEST_FILES[test_dir] = names
+	return _CACHED_TEST_FILES[test_dir]
+
+
+class BaseTest(unittest.TestCase):
+	replica = None
+	basePort = None
+	_myName = None
+	_testNum = None
+	_templateDataDir = None
+
+	def getTestNum(self):
+		cls = self.__class__
+		# don't reuse number cached for the parent test class
+		if cls.__dict__.get('_testNum') is None:
+			testFullName = inspect.getfile(cls)
+			names = get_test_files(os.path.dirname(testFullName))
+			cls._testNum = names.index(os.path.basename(testFullName))
+		return cls._testNum
 
 	def getBasePort(self):
 		if self.basePort is None:
@@ -42,7 +66,7 @@ class BaseTest(unittest.TestCase):
 
 	def getReplica(self) -> testgres.PostgresNode:
 		if self.replica is None:
-			baseDir = mkdtemp(prefix=self.myName + '_tgsb_')
+			baseDir = mkdtemp(prefix=self.myName + '_tgsb_', dir=TMP_DIR)
 			replica = self.node.backup(
 			    base_dir=baseDir).spawn_replica('replica')
 			replica.port = self.getBasePort() + 1
@@ -61,33 +85,61 @@ class BaseTest(unittest.TestCase):
 			self._myName = name
 		return self._myName
 
+	def getTemplateDataDir(self):
+		# initdb output and initial config are the same for every node, so
+		# prepare them once per process and copy the result for each test
+		if BaseTest._templateDataDir is None:
+			templateDir = mkdtemp(prefix='orioledb_tgst_', dir=TMP_DIR)
+			atexit.register(shutil.rmtree, templateDir, ignore_errors=True)
+			template = testgres.get_new_node('template',
+			                                 port=self.getBasePort(),
+			                                 base_dir=templateDir)
+			template.init(["--no-locale", "--encoding=UTF8"])  # run initdb
+			# testgres already sets fsync = off, torn pages aren't possible
+			# without OS crash, so full page images are useless as well.
+			# Don't spread non-immediate checkpoints like the one made by
+			# pg_basebackup in getReplica().
+			template.append_conf(
+			    'postgresql.conf', "shared_preload_libraries = orioledb\n"
+			    "full_page_writes = off\n"
+			    "checkpoint_completion_target = 0.0\n")
+			BaseTest._templateDataDir = template.data_dir
+		return BaseTest._templateDataDir
+
 	def setUp(self):
-		baseDir = mkdtemp(prefix=self.myName + '_tgsn_')
+		baseDir = mkdtemp(prefix=self.myName + '_tgsn_', dir=TMP_DIR)
 		self.startTime = time.time()
 		self.node = testgres.get_new_node('test',
 		                                  port=self.getBasePort(),
 		                                  base_dir=baseDir)
-		self.node.init(["--no-locale", "--encoding=UTF8"])  # run initdb
-		self.node.append_conf('postgresql.conf',
-		                      "shared_preload_libraries = orioledb\n")
+		copy_data_dir(self.getTemplateDataDir(), self.node.data_dir)
+		# template config has everything except the port of this node
+		self.node.append_conf(port=self.node.port)
 
 	def list2reason(self, exc_list):
 		if exc_list and exc_list[-1][0] is self:
 			return exc_list[-1][1]
 
-	def tearDown(self):
-		if hasattr(self._outcome, 'errors'):
+	# pick the way to get test result once, at class creation
+	if sys.version_info >= (3, 11):
+
+		def _extract_result(self):
+			return self._outcome.result
+	else:
+
+		def _extract_result(self):
 			# Python 3.4 - 3.10  (These two methods have no side effects)
 			result = self.defaultTestResult(
 			)  # these 2 methods have no side effects
 			self._feedErrorsToResult(result, self._outcome.errors)
-		else:
-			# Python 3.11+
-			result = self._outcome.result
+			return result
+
+	def tearDown(self):
+		result = self._extract_result()
 		error = self.list2reason(result.errors)
 		failure = self.list2reason(result.failures)
 		ok = not error and not failure
-		if self.node.status() == NodeStatus.Running:
+		if is_node_running(self.node):
 			self.node.stop(
 			)  # just comment it if node should not stops on fails
 			pass
@@ -96,7 +148,7 @@ class BaseTest(unittest.TestCase):
 		else:
 			print("\nBase directory: " + self.node.base_dir)
 		if self.replica:
-			if self.replica.status() == NodeStatus.Running:
+			if is_node_running(self.replica):
 				self.replica.stop(
 				)  # just comment it if node should not stops on fails
 				pass
@@ -109,15 +161,10 @@ class BaseTest(unittest.TestCase):
 		sys.stderr.write('%.3f s ' % (t, ))
 
 	def genString(self, id, length):
-		i = 0
-		chunkLen = 21
-		result = b''
-		while i * chunkLen < length:
-			m = hashlib.md5()
-			m.update((str(id) + '-' + str(i)).encode('ascii'))
-			result = result + base64.b64encode(m.digest())
-			i = i + 1
-		return result[0:length].decode('ascii')
+		# shake_128 gives an arbitrary length digest in a single pass
+		digest = hashlib.shake_128(str(id).encode('ascii')).digest(
+		    (length * 3 + 3) // 4)
+		return base64.b64encode(digest)[0:length].decode('ascii')
 
 	def assertErrorMessageEquals(self,
 	                             e: Exception,
@@ -129,34 +176,29 @@ class BaseTest(unittest.TestCase):
 		if (hasattr(e, 'exception')):
 			e = e.exception
 
-		if (hasattr(e, 'pgerror')) or (hasattr(e, 'message')):
-			exp_msg = "ERROR:  %s\n" % (err_msg)
-			if (second_msg != None):
-				exp_msg += "%s:  %s\n" % (second_title, second_msg)
-			if (third_msg != None):
-				exp_msg += "%s:  %s\n" % (third_title, third_msg)
-
-		if (hasattr(e, 'pgerror')):
-			msg = e.pgerror
-		elif (hasattr(e, 'message')):
-			msg = e.message
+		# error carries either full server message text in one of these
+		# attributes or a dict of message fields in args
+		for attr in ('pgerror', 'message'):
+			if hasattr(e, attr):
+				msg = getattr(e, attr)
+				exp_msg = "ERROR:  %s\n" % (err_msg)
+				if (second_msg != None):
+					exp_msg += "%s:  %s\n" % (second_title, second_msg)
+				if (third_msg != None):
+					exp_msg += "%s:  %s\n" % (third_title, third_msg)
+				break
 		else:
-			exp_msg = err_msg
 			msg = e.args[0]['M']
+			exp_msg = err_msg
 		self.assertEqual(msg, exp_msg)
 
 	@staticmethod
 	def get_pg_version():
-		return int(re.match(r'\d+', get_pg_version())[0])
+		return pg_major_version()
 
 	@staticmethod
 	def pg_with_icu():
-		with open(os.path.join(get_pg_config()["INCLUDEDIR"],
-		                       'pg_config.h')) as file:
-			for line in file:
-				if re.match(r'#define USE_ICU 1.*', line):
-					return True
-		return False
+		return pg_has_icu()
 
 	def catchup_orioledb(self, replica):
 		# wait for synchronization
@@ -165,79 +207,154 @@ class BaseTest(unittest.TestCase):
 		                         expected=True)
 
 
-# execute SQL query Thread for PostgreSql node's connection
-class ThreadQueryExecutor(Thread):
+# checks postmaster pid file directly instead of running pg_ctl status
+def is_node_running(node):
+	try:
+		with open(os.path.join(node.data_dir, PG_PID_FILE)) as f:
+			pid = int(f.readline())
+		os.kill(pid, 0)
+		return True
+	except (OSError, ValueError):
+		return False
+
+
+# PostgreSQL binaries don't change during the run, so ask them only once
+@functools.lru_cache(maxsize=1)
+def pg_major_version():
+	return int(re.match(r'\d+', get_pg_version())[0])
+
+
+@functools.lru_cache(maxsize=1)
+def pg_has_icu():
+	with open(os.path.join(get_pg_config()["INCLUDEDIR"],
+	                       'pg_config.h')) as file:
+		for line in file:
+			if re.match(r'#define USE_ICU 1.*', line):
+				return True
+	return False
+
+
+# copies data directory, cloning files where filesystem supports it
+def copy_data_dir(src, dst):
+	try:
+		subprocess.run(['cp', '-a', '--reflink=auto', src, dst],
+		               check=True,
+		               stderr=subprocess.DEVNULL)
+	except (OSError, subprocess.CalledProcessError):
+		# cp without GNU options, fallback to plain copy
+		shutil.rmtree(dst, ignore_errors=True)
+		shutil.copytree(src, dst, symlinks=True)
+
+
+# threads reused by ThreadQueryExecutor instead of spawning one per query
+_QUERY_POOL = ThreadPoolExecutor(
+    max_workers=int(os.getenv('TEST_QUERY_WORKERS', '16')))
+
+
+# execute SQL query in a pooled thread for PostgreSql node's connection
+class ThreadQueryExecutor:
 
 	def __init__(self, connection, sql_query):
-		Thread.__init__(self,
-		                target=ThreadQueryExecutor.execute_con,
-		                args=(connection, sql_query))
-		self._return = None
+		self._connection = connection
+		self._sql_query = sql_query
+		self._future = None
 
-	def run(self):
-		try:
-			if self._target:
-				self._return = self._target(*self._args)
-		finally:
-			del self._target, self._args
+	def start(self):
+		self._future = _QUERY_POOL.submit(self._connection.execute,
+		                                  self._sql_query)
 
+	# returns query result or raises its exception
 	def join(self, timeout=None):
-		Thread.join(self, timeout)
-		if isinstance(self._return, Exception):
-			raise self._return
-		return self._return
+		return self._future.result(timeout)
 
-	@staticmethod
-	def execute_con(connection, sql_query):
-		try:
-			return connection.execute(sql_query)
-		except Exception as e:
-			return e
+
+GENERATE_STRING_CHARS = string.ascii_uppercase + string.ascii_lowercase + string.digits
 
 
 def generate_string(size, seed=None):
-	if seed:
-		random.seed(seed)
-	chars = string.ascii_uppercase + string.ascii_lowercase + string.digits
-	return ''.join(random.choice(chars) for _ in range(size))
+	# seeded strings use their own generator and don't reset global random
+	# state, unseeded ones still follow random.seed() made by the test
+	rng = random.Random(seed) if seed is not None else random
+	return ''.join(rng.choices(GENERATE_STRING_CHARS, k=size))
+
+
+# polls predicate until it returns a true value, sleeping initial seconds
+# after the first failed probe and multiplying the delay by factor up to cap
+def adaptive_poll(predicate, initial=0.001, cap=0.1, factor=2.0, timeout=None):
+	delay = initial
+	deadline = None if timeout is None else time.time() + timeout
+	while True:
+		result = predicate()
+		if result:
+			return result
+		if deadline is not None and time.time() >= deadline:
+			raise TimeoutError("adaptive_poll timed out after %.3f s" %
+			                   (timeout, ))
+		time.sleep(delay)
+		delay = min(delay * factor, cap)
+
+
+# yields given connection or a new autocommit one, closed on exit, so
+# repeated probes don't pay for connection setup each time
+@contextlib.contextmanager
+def probe_connection(node, con=None):
+	if con is not None:
+		yield con
+		return
+	con = node.connect(autocommit=True)
+	try:
+		yield con
+	finally:
+		con.close()
 
 
-def wait_stopevent(node, blocked_pid):
-	while node.execute("""SELECT EXISTS(
+def wait_stopevent(node, blocked_pid, con=None):
+	with probe_connection(node, con) as con:
+		con.execute("""PREPARE wait_stopevent_check(int[]) AS
+						 SELECT EXISTS(
 							 SELECT se.*
 							 FROM pg_stopevents() se
-							 WHERE se.waiter_pids @> ARRAY[%d]
-						  );""" % (blocked_pid, ))[0][0] == False:
-		time.sleep(0.1)
-		continue
-
-
-# waits for blocking checkpointer process on breakpoint by process with pid = block_pid
-def wait_checkpointer_stopevent(node):
-	checkpointer_pid = None
-	while checkpointer_pid == None:
-		select_list = node.execute(
-		    "SELECT pid FROM pg_stat_activity WHERE backend_type = 'checkpointer';"
-		)
-		# checkpointer may not start yet, check list range
-		if len(select_list) > 0 and len(select_list[0]) > 0:
-			checkpointer_pid = select_list[0][0]
-
-	wait_stopevent(node, checkpointer_pid)
-
-
-# waits for blocking bgwriter process on breakpoint by process with pid = block_pid
-def wait_bgwriter_stopevent(node):
-	bgwriter_pid = None
-	while bgwriter_pid == None:
-		select_list = node.execute(
-		    "SELECT pid FROM pg_stat_activity WHERE backend_type = 'orioledb background writer';"
-		)
-		# checkpointer may not start yet, check list range
-		if len(select_list) > 0 and len(select_list[0]) > 0:
-			bgwriter_pid = select_list[0][0]
-
-	wait_stopevent(node, bgwriter_pid)
+							 WHERE se.waiter_pids @> $1
+						 );""")
+		check = "EXECUTE wait_stopevent_check(ARRAY[%d]);" % (blocked_pid, )
+		try:
+			adaptive_poll(lambda: con.execute(check)[0][0])
+		finally:
+			con.execute("DEALLOCATE wait_stopevent_check;")
+
+
+# waits for blocking process with given backend_type on breakpoint; the
+# first probe fetches its pid and checks for the stopevent in one round trip,
+# later probes only check pg_stopevents() for the cached pid
+def wait_backend_stopevent(node, backend_type, con=None):
+	with probe_connection(node, con) as con:
+
+		def probe():
+			select_list = con.execute("""SELECT a.pid, EXISTS(
+											 SELECT 1
+											 FROM pg_stopevents() se
+											 WHERE se.waiter_pids @> ARRAY[a.pid]
+										 )
+										 FROM pg_stat_activity a
+										 WHERE a.backend_type = '%s';""" % (backend_type, ))
+			# process may not start yet, check list range
+			if len(select_list) > 0 and len(select_list[0]) > 0:
+				return select_list[0]
+			return None
+
+		pid, waiting = adaptive_poll(probe)
+		if not waiting:
+			wait_stopevent(node, pid, con)
+
+
+# waits for blocking checkpointer process on breakpoint
+def wait_checkpointer_stopevent(node, con=None):
+	wait_backend_stopevent(node, 'checkpointer', con)
+
+
+# waits for blocking bgwriter process on breakpoint
+def wait_bgwriter_stopevent(node, con=None):
+	wait_backend_stopevent(node, 'orioledb background writer', con)
 
 
 # workaround for testgres error messages on empty results